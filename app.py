@@ -1869,6 +1869,21 @@ def init_deposit_scheduler():
 
 init_deposit_scheduler()
 
+risk_scoring_engine = None
+
+def init_risk_scoring_engine():
+    """Inicializar el recalculo programado de scores de riesgo."""
+    global risk_scoring_engine
+    if db_manager:
+        try:
+            from bot.tracking_correos.risk_scoring import start_risk_scoring_engine
+            risk_scoring_engine = start_risk_scoring_engine(db_manager)
+            logger.info("Risk scoring engine started successfully")
+        except Exception as e:
+            logger.error(f"Failed to start risk scoring engine: {e}")
+
+init_risk_scoring_engine()
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=True)
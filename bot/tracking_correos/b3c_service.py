@@ -11,6 +11,8 @@ from typing import Optional, Dict, Any, Tuple
 from functools import lru_cache
 import time
 
+from bot.tracking_correos.price_service import price_service
+
 logger = logging.getLogger(__name__)
 
 class B3CTokenService:
@@ -94,12 +96,14 @@ class B3CTokenService:
                 return cached_data
         
         fixed_price_data = self._get_fixed_price()
-        self._price_cache[cache_key] = (fixed_price_data, now)
+        if not fixed_price_data['ton_price_is_stale']:
+            self._price_cache[cache_key] = (fixed_price_data, now)
         return fixed_price_data
     
     def _get_fixed_price(self) -> Dict[str, Any]:
         """Precio fijo controlado por el administrador (sin pool de liquidez)."""
-        ton_usd = Decimal(str(self._get_ton_usd_price()))
+        ton_quote, ton_status = self._get_ton_usd_quote()
+        ton_usd = Decimal(str(ton_quote))
         price_ton = self.fixed_price_usd / ton_usd if ton_usd > 0 else Decimal('0.02')
         
         return {
@@ -117,6 +121,9 @@ class B3CTokenService:
             'source': 'fixed_price',
             'is_testnet': self.use_testnet,
             'is_fixed_price': True,
+            'ton_usd': float(ton_usd),
+            'ton_price_source': ton_status['source'],
+            'ton_price_is_stale': ton_status['is_stale'],
             'notice': f'Precio fijo: ${self.fixed_price_usd} USD por B3C'
         }
     
@@ -169,20 +176,20 @@ class B3CTokenService:
             'notice': 'Precio simulado - Token aún no desplegado'
         }
     
+    def _get_ton_usd_quote(self) -> Tuple[float, Dict[str, Any]]:
+        """
+        Obtener precio de TON en USD desde el feed compartido (sin esperar a la red)
+        junto con su origen y frescura, para distinguir un precio de respaldo de uno real.
+        """
+        price = price_service.get_price('TON', 'usd')
+        status = price_service.get_price_status()
+        if not price or price <= 0:
+            return 5.0, {'source': 'fallback', 'is_stale': True}
+        return price, {'source': status['source'], 'is_stale': status['is_stale']}
+    
     def _get_ton_usd_price(self) -> float:
-        """Obtener precio de TON en USD."""
-        try:
-            response = requests.get(
-                'https://api.coingecko.com/api/v3/simple/price',
-                params={'ids': 'the-open-network', 'vs_currencies': 'usd'},
-                timeout=5
-            )
-            if response.status_code == 200:
-                data = response.json()
-                return data.get('the-open-network', {}).get('usd', 5.0)
-        except Exception as e:
-            logger.warning(f"Error fetching TON price: {e}")
-        return 5.0
+        """Obtener precio de TON en USD desde el feed compartido (sin esperar a la red)."""
+        return self._get_ton_usd_quote()[0]
     
     def calculate_b3c_from_ton(self, ton_amount: float) -> Dict[str, Any]:
         """
@@ -220,6 +227,8 @@ class B3CTokenService:
             'min_b3c_amount': float(min_b3c),
             'price_per_b3c': float(price_ton),
             'slippage_percent': float(slippage * 100),
+            'price_is_stale': price_data.get('ton_price_is_stale', False),
+            'price_source': price_data.get('ton_price_source'),
             'price_data': price_data
         }
     
@@ -259,6 +268,8 @@ class B3CTokenService:
             'min_ton': float(min_ton),
             'price_per_b3c': float(price_ton),
             'slippage_percent': float(slippage * 100),
+            'price_is_stale': price_data.get('ton_price_is_stale', False),
+            'price_source': price_data.get('ton_price_source'),
             'price_data': price_data
         }
     
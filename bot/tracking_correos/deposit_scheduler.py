@@ -12,6 +12,18 @@ from typing import Optional
 
 logger = logging.getLogger(__name__)
 
+CREATE_SCHEDULED_JOB_RUNS_SQL = """
+CREATE TABLE IF NOT EXISTS scheduled_job_runs (
+    job_name VARCHAR(100) PRIMARY KEY,
+    last_run_at TIMESTAMP,
+    lease_until TIMESTAMP
+);
+ALTER TABLE scheduled_job_runs ADD COLUMN IF NOT EXISTS lease_until TIMESTAMP;
+ALTER TABLE scheduled_job_runs ALTER COLUMN last_run_at DROP NOT NULL;
+"""
+
+WALLET_SYNC_JOB = 'personal_wallet_sync'
+
 class DepositScheduler:
     """Scheduler para polling automático de depósitos en wallets del pool."""
     
@@ -19,6 +31,9 @@ class DepositScheduler:
     EXPIRATION_CHECK_INTERVAL = 60
     MIN_POOL_CHECK_INTERVAL = 300
     CONSOLIDATION_INTERVAL = 60
+    WALLET_SYNC_HOUR = int(os.environ.get('WALLET_SYNC_HOUR', '3'))
+    WALLET_SYNC_CHECK_INTERVAL = 600
+    WALLET_SYNC_LEASE_SECONDS = 6 * 3600
     
     def __init__(self, db_manager, wallet_pool_service=None):
         """
@@ -35,6 +50,8 @@ class DepositScheduler:
         self._last_pool_check = 0
         self._last_expiration_check = 0
         self._last_consolidation_check = 0
+        self._last_wallet_sync_check = 0
+        self._wallet_sync_thread: Optional[threading.Thread] = None
         
         logger.info("DepositScheduler initialized")
     
@@ -88,6 +105,10 @@ class DepositScheduler:
                     self._ensure_pool_size()
                     self._last_pool_check = current_time
                 
+                if current_time - self._last_wallet_sync_check > self.WALLET_SYNC_CHECK_INTERVAL:
+                    self._start_wallet_sync()
+                    self._last_wallet_sync_check = current_time
+                
             except Exception as e:
                 logger.error(f"[SCHEDULER] Error in deposit check loop: {e}")
             
@@ -181,6 +202,82 @@ class DepositScheduler:
         except Exception as e:
             logger.error(f"[SCHEDULER] Error ensuring pool size: {e}")
     
+    def _start_wallet_sync(self):
+        """Comprobar en su propio hilo si toca la sincronizacion diaria de wallets."""
+        if self._wallet_sync_thread and self._wallet_sync_thread.is_alive():
+            return
+        self._wallet_sync_thread = threading.Thread(target=self._sync_personal_wallets, daemon=True)
+        self._wallet_sync_thread.start()
+    
+    def _wallet_sync_slot(self, now: datetime) -> datetime:
+        """Ultima hora programada (WALLET_SYNC_HOUR) anterior o igual a `now`."""
+        slot = now.replace(hour=self.WALLET_SYNC_HOUR, minute=0, second=0, microsecond=0)
+        if now < slot:
+            slot -= timedelta(days=1)
+        return slot
+    
+    def _claim_wallet_sync(self) -> Optional[datetime]:
+        """
+        Reclamar el lease de la sincronizacion diaria si toca ejecutarla.
+        
+        Returns:
+            Hora de inicio (reloj de la base de datos) si este worker debe sincronizar,
+            None si ya se hizo en el turno actual o si otro worker tiene el lease
+        """
+        with self.db.get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(CREATE_SCHEDULED_JOB_RUNS_SQL)
+                cur.execute("SELECT LOCALTIMESTAMP")
+                now = cur.fetchone()[0]
+                cur.execute("""
+                    INSERT INTO scheduled_job_runs (job_name, lease_until)
+                    VALUES (%(job)s, LOCALTIMESTAMP + make_interval(secs => %(lease)s))
+                    ON CONFLICT (job_name) DO UPDATE SET lease_until = EXCLUDED.lease_until
+                    WHERE (scheduled_job_runs.lease_until IS NULL
+                           OR scheduled_job_runs.lease_until < LOCALTIMESTAMP)
+                      AND (scheduled_job_runs.last_run_at IS NULL
+                           OR scheduled_job_runs.last_run_at < %(slot)s)
+                    RETURNING job_name
+                """, {'job': WALLET_SYNC_JOB, 'lease': self.WALLET_SYNC_LEASE_SECONDS,
+                      'slot': self._wallet_sync_slot(now)})
+                claimed = cur.fetchone() is not None
+                conn.commit()
+        return now if claimed else None
+    
+    def _sync_personal_wallets(self):
+        """
+        Sincronizar balances de todas las wallets personales con la blockchain.
+        
+        Se ejecuta una vez al dia a partir de WALLET_SYNC_HOUR. La ultima ejecucion
+        se guarda en scheduled_job_runs (sobrevive a reinicios, y una ejecucion
+        perdida se recupera al arrancar) y un lease en la misma fila evita que varios
+        workers sincronicen a la vez sin retener una conexion durante la sincronizacion.
+        Si el worker muere, otro retoma el trabajo cuando expira el lease.
+        """
+        try:
+            started_at = self._claim_wallet_sync()
+            if started_at is None:
+                return
+            
+            result = {}
+            try:
+                logger.info("[SCHEDULER] Starting daily personal wallet sync")
+                from bot.tracking_correos.personal_wallet_service import PersonalWalletService
+                result = PersonalWalletService(self.db).sync_all_wallets()
+                logger.info(f"[SCHEDULER] Personal wallet sync finished: {result}")
+            finally:
+                with self.db.get_connection() as conn:
+                    with conn.cursor() as cur:
+                        cur.execute("""
+                            UPDATE scheduled_job_runs SET
+                                last_run_at = CASE WHEN %s THEN %s ELSE last_run_at END,
+                                lease_until = NULL
+                            WHERE job_name = %s
+                        """, (bool(result.get('success')), started_at, WALLET_SYNC_JOB))
+                        conn.commit()
+        except Exception as e:
+            logger.error(f"[SCHEDULER] Error syncing personal wallets: {e}")
+    
     def _send_notification(self, user_id: str, purchase_id: str, result: dict):
         """Enviar notificación al usuario cuando se detecta un depósito."""
         try:
@@ -0,0 +1,287 @@
+"""
+Identity Links - Indice de cuentas relacionadas para deteccion de fraude
+Agrupa usuarios que comparten IP, huella de dispositivo o wallet usando union-find.
+
+El indice se construye una vez desde la base de datos y luego se mantiene de forma
+incremental cuando se agrega un dispositivo de confianza o se registra una wallet.
+Como cada worker tiene su propia copia, se reconstruye periodicamente para incorporar
+cambios hechos por otros procesos (y para separar clusters tras un cambio de wallet,
+ya que union-find no admite borrados).
+"""
+
+import time
+import heapq
+import logging
+import threading
+from typing import Optional, Dict, List, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+LINK_IP = 'ip'
+LINK_FINGERPRINT = 'fingerprint'
+LINK_WALLET = 'wallet'
+
+
+class IdentityIndexUnavailable(Exception):
+    """El indice nunca se pudo cargar desde la base de datos."""
+
+
+class IdentityLinkIndex:
+    """Indice union-find de usuarios enlazados por IP, fingerprint y wallet."""
+
+    REBUILD_INTERVAL_SECONDS = 600
+    RETRY_AFTER_FAILURE_SECONDS = 60
+
+    def __init__(self, db_manager):
+        """
+        Inicializar el indice (se carga de forma perezosa en el primer uso).
+
+        Args:
+            db_manager: Instancia de DatabaseManager
+        """
+        self.db = db_manager
+        self._lock = threading.RLock()
+        self._rebuild_lock = threading.Lock()
+        self._rebuilding = False
+        self._pending: List[Tuple] = []
+        self._loaded_at = 0
+        self._failed_at = 0
+        self._reset()
+
+    def _reset(self):
+        self._parent: Dict[str, str] = {}
+        self._members: Dict[str, Set[str]] = {}
+        self._links: Dict[Tuple[str, str], Set[str]] = {}
+        self._user_links: Dict[str, Set[Tuple[str, str]]] = {}
+
+    def _find(self, user_id: str) -> str:
+        parent = self._parent.setdefault(user_id, user_id)
+        if parent == user_id:
+            self._members.setdefault(user_id, {user_id})
+            return user_id
+        root = user_id
+        while self._parent[root] != root:
+            root = self._parent[root]
+        while self._parent[user_id] != root:
+            self._parent[user_id], user_id = root, self._parent[user_id]
+        return root
+
+    def _union(self, a: str, b: str):
+        root_a, root_b = self._find(a), self._find(b)
+        if root_a == root_b:
+            return
+        if len(self._members[root_a]) < len(self._members[root_b]):
+            root_a, root_b = root_b, root_a
+        self._parent[root_b] = root_a
+        self._members[root_a] |= self._members.pop(root_b)
+
+    def _add_link(self, user_id: str, link_type: str, value) -> None:
+        value = str(value).strip() if value is not None else ''
+        if not user_id or not value:
+            return
+        key = (link_type, value)
+        users = self._links.setdefault(key, set())
+        if user_id in users:
+            return
+        self._find(user_id)
+        if users:
+            self._union(user_id, next(iter(users)))
+        users.add(user_id)
+        self._user_links.setdefault(user_id, set()).add(key)
+
+    def _remove_links(self, user_id: str, link_type: str) -> None:
+        for key in [k for k in self._user_links.get(user_id, ()) if k[0] == link_type]:
+            self._user_links[user_id].discard(key)
+            users = self._links.get(key)
+            if users is not None:
+                users.discard(user_id)
+                if not users:
+                    del self._links[key]
+
+    def rebuild(self) -> bool:
+        """
+        Reconstruir el indice completo desde la base de datos.
+
+        Las actualizaciones incrementales que llegan mientras se leen las tablas se
+        guardan en _pending y se vuelven a aplicar sobre el indice nuevo.
+        """
+        with self._lock:
+            self._rebuilding = True
+            self._pending = []
+        try:
+            with self.db.get_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        SELECT user_id, ip_address, device_fingerprint
+                        FROM trusted_devices
+                    """)
+                    devices = cur.fetchall()
+                    cur.execute("""
+                        SELECT id, wallet_address FROM users
+                        WHERE wallet_address IS NOT NULL AND wallet_address != ''
+                    """)
+                    wallets = cur.fetchall()
+        except Exception as e:
+            logger.error(f"Error rebuilding identity link index: {e}")
+            with self._lock:
+                self._rebuilding = False
+                self._failed_at = time.time()
+            return False
+
+        with self._lock:
+            self._reset()
+            for user_id, ip_address, fingerprint in devices:
+                self._add_link(str(user_id), LINK_IP, ip_address)
+                self._add_link(str(user_id), LINK_FINGERPRINT, fingerprint)
+            for user_id, wallet_address in wallets:
+                self._add_link(str(user_id), LINK_WALLET, wallet_address)
+            for update, args in self._pending:
+                update(*args)
+            self._pending = []
+            self._rebuilding = False
+            self._loaded_at = time.time()
+
+        logger.info(f"Identity link index rebuilt: {len(devices)} devices, {len(wallets)} wallets")
+        return True
+
+    @property
+    def is_loaded(self) -> bool:
+        """True si el indice se cargo al menos una vez."""
+        return bool(self._loaded_at)
+
+    def _ensure_loaded(self):
+        """
+        Cargar el indice si hace falta.
+
+        La primera carga se hace en el hilo que llama (un solo hilo consulta, los
+        demas esperan). Las recargas periodicas van en un hilo de background y se
+        sigue sirviendo el indice anterior. Tras un fallo se espera antes de reintentar.
+
+        Raises:
+            IdentityIndexUnavailable: si el indice nunca se ha podido cargar (un
+                indice vacio daria falsos negativos en vez de un error).
+        """
+        now = time.time()
+        retry_allowed = now - self._failed_at >= self.RETRY_AFTER_FAILURE_SECONDS
+
+        if self._loaded_at:
+            if now - self._loaded_at >= self.REBUILD_INTERVAL_SECONDS and retry_allowed:
+                if self._rebuild_lock.acquire(blocking=False):
+                    threading.Thread(target=self._background_rebuild, daemon=True).start()
+            return
+
+        if retry_allowed:
+            with self._rebuild_lock:
+                if not self._loaded_at and time.time() - self._failed_at >= self.RETRY_AFTER_FAILURE_SECONDS:
+                    self.rebuild()
+        if not self._loaded_at:
+            raise IdentityIndexUnavailable('Indice de cuentas relacionadas no disponible')
+
+    def wait_until_loaded(self) -> bool:
+        """Cargar el indice si aun no lo esta. Devuelve False si no hay indice disponible."""
+        try:
+            self._ensure_loaded()
+            return True
+        except IdentityIndexUnavailable:
+            return False
+
+    def _background_rebuild(self):
+        """Recarga periodica; libera el lock tomado en _ensure_loaded."""
+        try:
+            self.rebuild()
+        finally:
+            self._rebuild_lock.release()
+
+    def _apply_device(self, user_id: str, ip_address: str, device_fingerprint: str):
+        self._add_link(user_id, LINK_IP, ip_address)
+        self._add_link(user_id, LINK_FINGERPRINT, device_fingerprint)
+
+    def _apply_wallet(self, user_id: str, wallet_address: str):
+        self._remove_links(user_id, LINK_WALLET)
+        self._add_link(user_id, LINK_WALLET, wallet_address)
+
+    def add_device(self, user_id: str, ip_address: str = None, device_fingerprint: str = None):
+        """Registrar un dispositivo de confianza recien agregado."""
+        args = (str(user_id), ip_address, device_fingerprint)
+        with self._lock:
+            self._apply_device(*args)
+            if self._rebuilding:
+                self._pending.append((self._apply_device, args))
+
+    def set_wallet(self, user_id: str, wallet_address: str):
+        """Registrar la wallet actual de un usuario (reemplaza la anterior)."""
+        args = (str(user_id), wallet_address)
+        with self._lock:
+            self._apply_wallet(*args)
+            if self._rebuilding:
+                self._pending.append((self._apply_wallet, args))
+
+    def get_related(self, user_id: str) -> Dict[str, Dict[str, str]]:
+        """
+        Obtener los usuarios que comparten algun enlace directo con user_id.
+
+        Returns:
+            Dict user_id -> evidencia {'ip': ..., 'fingerprint': ..., 'wallet': ...}
+        """
+        self._ensure_loaded()
+        user_id = str(user_id)
+        related: Dict[str, Dict[str, str]] = {}
+        with self._lock:
+            for link_type, value in self._user_links.get(user_id, ()):
+                for other in self._links.get((link_type, value), ()):
+                    if other != user_id:
+                        related.setdefault(other, {})[link_type] = value
+        return related
+
+    def get_cluster(self, user_id: str) -> Set[str]:
+        """Obtener todos los usuarios del cluster (enlaces transitivos) de user_id."""
+        self._ensure_loaded()
+        user_id = str(user_id)
+        with self._lock:
+            if user_id not in self._parent:
+                return {user_id}
+            return set(self._members[self._find(user_id)])
+
+    def get_largest_clusters(self, limit: int = 50) -> List[Dict]:
+        """Obtener los clusters con mas de un usuario, ordenados por tamano."""
+        self._ensure_loaded()
+        with self._lock:
+            roots = [root for root, members in self._members.items() if len(members) > 1]
+            largest = heapq.nlargest(limit, roots, key=lambda root: len(self._members[root]))
+            return [{
+                'size': len(self._members[root]),
+                'user_ids': sorted(self._members[root])
+            } for root in largest]
+
+    def get_shared_links(self, link_type: str, limit: int = 50) -> List[Dict]:
+        """Obtener los valores de un tipo de enlace compartidos por mas de un usuario."""
+        self._ensure_loaded()
+        with self._lock:
+            shared = [(key[1], users) for key, users in self._links.items()
+                      if key[0] == link_type and len(users) > 1]
+            largest = heapq.nlargest(limit, shared, key=lambda item: len(item[1]))
+            return [{
+                'value': value,
+                'user_count': len(users),
+                'user_ids': sorted(users)
+            } for value, users in largest]
+
+    def count_shared_ips(self, user_id: str) -> int:
+        """Contar las IPs de user_id que tambien usa algun otro usuario."""
+        self._ensure_loaded()
+        user_id = str(user_id)
+        with self._lock:
+            return sum(
+                1 for key in self._user_links.get(user_id, ())
+                if key[0] == LINK_IP and len(self._links.get(key, ())) > 1
+            )
+
+
+_index_instance: Optional[IdentityLinkIndex] = None
+
+def get_identity_link_index(db_manager) -> IdentityLinkIndex:
+    """Obtener o crear instancia singleton del indice de cuentas relacionadas."""
+    global _index_instance
+    if _index_instance is None:
+        _index_instance = IdentityLinkIndex(db_manager)
+    return _index_instance
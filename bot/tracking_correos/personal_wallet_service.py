@@ -9,10 +9,15 @@ import secrets
 import hashlib
 import base64
 import json
+import time
+import threading
 import requests
+import psycopg2.extras
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from datetime import datetime, timedelta
 from decimal import Decimal
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Tuple
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import padding
@@ -29,12 +34,48 @@ except ImportError:
     logger.warning("tonsdk not available - using simulated wallet generation")
 
 
+class _RateLimiter:
+    """Espaciado minimo entre peticiones, compartido entre hilos."""
+    
+    def __init__(self, requests_per_second: float):
+        self.interval = 1.0 / requests_per_second
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+    
+    def acquire(self):
+        """Esperar hasta el siguiente hueco libre."""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
 class PersonalWalletService:
     """Servicio para gestionar wallets personales multi-token de usuarios."""
     
     TONCENTER_API_V3 = 'https://toncenter.com/api/v3'
     TESTNET_API = 'https://testnet.toncenter.com/api/v2'
     
+    SYNC_MAX_WORKERS = int(os.environ.get('WALLET_SYNC_MAX_WORKERS', '8'))
+    SYNC_BATCH_SIZE = 200
+    HTTP_TIMEOUT = 10
+    
+    # TON Center: 1 req/s sin API key, 10 req/s con API key
+    TONCENTER_RPS_NO_KEY = 1
+    TONCENTER_RPS_WITH_KEY = 10
+    TONCENTER_MAX_RETRIES = 3
+    TONCENTER_MAX_BACKOFF_SECONDS = 30
+    
+    TOKEN_SYMBOL_MAX_LENGTH = 20
+    TOKEN_NAME_MAX_LENGTH = 100
+    
+    _http_session: Optional[requests.Session] = None
+    _http_executor: Optional[ThreadPoolExecutor] = None
+    _rate_limiters: Dict[bool, _RateLimiter] = {}
+    _http_lock = threading.Lock()
+    
     MAIN_TOKENS = {
         'B3C': {
             'address': os.environ.get('B3C_TOKEN_ADDRESS', ''),
@@ -508,10 +549,172 @@ class PersonalWalletService:
             logger.error(f"Error getting withdrawal fee: {e}")
             return {'fee_type': 'percent', 'fee_value': 2.0, 'min_withdrawal': 0}
     
+    @classmethod
+    def _get_http(cls) -> Tuple[requests.Session, ThreadPoolExecutor]:
+        """Sesion HTTP (keep-alive) y pool de hilos compartidos entre instancias."""
+        if cls._http_session is None:
+            with cls._http_lock:
+                if cls._http_session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=cls.SYNC_MAX_WORKERS * 2)
+                    session.mount('https://', adapter)
+                    cls._http_executor = ThreadPoolExecutor(
+                        max_workers=cls.SYNC_MAX_WORKERS, thread_name_prefix='wallet-sync'
+                    )
+                    cls._http_session = session
+        return cls._http_session, cls._http_executor
+    
+    def _toncenter_headers(self) -> Dict[str, str]:
+        headers = {'Content-Type': 'application/json'}
+        if self.toncenter_api_key:
+            headers['X-API-Key'] = self.toncenter_api_key
+        return headers
+    
+    def _get_rate_limiter(self) -> _RateLimiter:
+        """Limitador del proceso segun haya o no API key de TON Center."""
+        has_key = bool(self.toncenter_api_key)
+        limiter = self._rate_limiters.get(has_key)
+        if limiter is None:
+            with self._http_lock:
+                limiter = self._rate_limiters.get(has_key)
+                if limiter is None:
+                    default_rps = self.TONCENTER_RPS_WITH_KEY if has_key else self.TONCENTER_RPS_NO_KEY
+                    rps = float(os.environ.get('TONCENTER_REQUESTS_PER_SECOND', default_rps))
+                    limiter = _RateLimiter(rps)
+                    self._rate_limiters[has_key] = limiter
+        return limiter
+    
+    def _toncenter_get(self, url: str) -> requests.Response:
+        """GET a TON Center respetando el rate limit y reintentando los 429 con backoff."""
+        session, _ = self._get_http()
+        limiter = self._get_rate_limiter()
+        
+        for attempt in range(self.TONCENTER_MAX_RETRIES + 1):
+            limiter.acquire()
+            response = session.get(url, headers=self._toncenter_headers(), timeout=self.HTTP_TIMEOUT)
+            if response.status_code != 429 or attempt == self.TONCENTER_MAX_RETRIES:
+                return response
+            
+            try:
+                delay = float(response.headers.get('Retry-After'))
+            except (TypeError, ValueError):
+                delay = 2 ** attempt
+            delay = min(delay, self.TONCENTER_MAX_BACKOFF_SECONDS)
+            logger.warning(f"TON Center rate limited (429), retrying in {delay:.1f}s")
+            time.sleep(delay)
+        
+        return response
+    
+    def _fetch_ton_balance(self, wallet_address: str) -> Optional[List[Tuple]]:
+        """Consultar balance TON nativo. Devuelve None si la consulta falla."""
+        base_url = self.TESTNET_API if self.use_testnet else self.TONCENTER_API_V3
+        try:
+            account_url = f"{base_url}/getAddressInformation?address={wallet_address}"
+            response = self._toncenter_get(account_url)
+            
+            if response.status_code != 200:
+                return None
+            data = response.json()
+            if not (data.get('ok') and data.get('result')):
+                return None
+            
+            balance_nano = int(data['result'].get('balance', 0))
+            balance_ton = Decimal(balance_nano) / Decimal(10**9)
+            return [('native', 'TON', 'Toncoin', 9, balance_ton)]
+        except Exception as e:
+            logger.warning(f"Could not sync TON balance: {e}")
+            return None
+    
+    def _fetch_jetton_balances(self, wallet_address: str) -> Optional[List[Tuple]]:
+        """Consultar balances de Jettons. Devuelve None si la consulta falla."""
+        base_url = self.TESTNET_API if self.use_testnet else self.TONCENTER_API_V3
+        try:
+            jettons_url = f"{base_url.replace('/v2', '/v3')}/jetton/wallets?owner_address={wallet_address}&limit=100"
+            if self.use_testnet:
+                jettons_url = f"https://testnet.toncenter.com/api/v3/jetton/wallets?owner_address={wallet_address}&limit=100"
+            
+            response = self._toncenter_get(jettons_url)
+            if response.status_code != 200:
+                return None
+            
+            balances = []
+            for jetton in response.json().get('jetton_wallets', []):
+                try:
+                    jetton_master = jetton.get('jetton', {}).get('address', '')
+                    balance_raw = int(jetton.get('balance', 0))
+                    metadata = jetton.get('jetton', {}).get('metadata', {})
+                    
+                    decimals = int(metadata.get('decimals', 9))
+                    balance = Decimal(balance_raw) / Decimal(10**decimals)
+                    
+                    if balance > 0:
+                        balances.append((
+                            jetton_master,
+                            str(metadata.get('symbol') or 'UNKNOWN')[:self.TOKEN_SYMBOL_MAX_LENGTH],
+                            str(metadata.get('name') or 'Unknown Token')[:self.TOKEN_NAME_MAX_LENGTH],
+                            decimals,
+                            balance
+                        ))
+                except Exception as je:
+                    logger.warning(f"Could not process jetton: {je}")
+            return balances
+        except Exception as e:
+            logger.warning(f"Could not sync jetton balances: {e}")
+            return None
+    
+    def _execute_balance_upsert(self, rows: List[Tuple]):
+        with self.db.get_connection() as conn:
+            with conn.cursor() as cur:
+                psycopg2.extras.execute_values(cur, """
+                    INSERT INTO token_balances 
+                    (user_id, token_address, token_symbol, token_name, 
+                     token_decimals, balance, last_synced)
+                    VALUES %s
+                    ON CONFLICT (user_id, token_address) DO UPDATE SET
+                        balance = EXCLUDED.balance,
+                        token_symbol = COALESCE(EXCLUDED.token_symbol, token_balances.token_symbol),
+                        token_name = COALESCE(EXCLUDED.token_name, token_balances.token_name),
+                        last_synced = NOW()
+                """, rows, template="(%s, %s, %s, %s, %s, %s, NOW())", page_size=1000)
+                conn.commit()
+    
+    def _upsert_token_balances(self, rows: List[Tuple]) -> Tuple[int, int]:
+        """
+        Guardar balances de varios tokens (y usuarios) en una sola sentencia.
+        Si la sentencia falla se reintenta fila a fila, asi un token invalido
+        solo se pierde a si mismo.
+        
+        Args:
+            rows: Tuplas (user_id, token_address, symbol, name, decimals, balance)
+            
+        Returns:
+            Tupla (balances guardados, balances fallidos)
+        """
+        unique_rows = list({(row[0], row[1]): row for row in rows}.values())
+        if not unique_rows:
+            return 0, 0
+        
+        try:
+            self._execute_balance_upsert(unique_rows)
+            return len(unique_rows), 0
+        except Exception as e:
+            logger.warning(f"Bulk balance upsert failed, retrying row by row: {e}")
+        
+        saved = failed = 0
+        for row in unique_rows:
+            try:
+                self._execute_balance_upsert([row])
+                saved += 1
+            except Exception as e:
+                failed += 1
+                logger.warning(f"Could not save balance {row[1]} for user {row[0]}: {e}")
+        return saved, failed
+    
     def sync_wallet_from_blockchain(self, user_id: str) -> Dict[str, Any]:
         """
         Sincronizar balances de wallet desde la blockchain.
-        Consulta TON Center API para obtener balances reales.
+        Consulta TON Center API (balance TON y Jettons en paralelo) y guarda
+        todos los balances en una sola sentencia.
         """
         try:
             wallet_result = self.get_or_create_wallet(user_id)
@@ -520,67 +723,102 @@ class PersonalWalletService:
             
             wallet_address = wallet_result['wallet']['address']
             
-            base_url = self.TESTNET_API if self.use_testnet else self.TONCENTER_API_V3
-            
-            headers = {'Content-Type': 'application/json'}
-            if self.toncenter_api_key:
-                headers['X-API-Key'] = self.toncenter_api_key
+            _, executor = self._get_http()
+            ton_future = executor.submit(self._fetch_ton_balance, wallet_address)
+            jettons_future = executor.submit(self._fetch_jetton_balances, wallet_address)
             
-            try:
-                account_url = f"{base_url}/getAddressInformation?address={wallet_address}"
-                response = requests.get(account_url, headers=headers, timeout=10)
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    if data.get('ok') and data.get('result'):
-                        balance_nano = int(data['result'].get('balance', 0))
-                        balance_ton = Decimal(balance_nano) / Decimal(10**9)
-                        
-                        self.update_token_balance(user_id, 'native', balance_ton, {
-                            'symbol': 'TON',
-                            'name': 'Toncoin',
-                            'decimals': 9
-                        })
-            except Exception as e:
-                logger.warning(f"Could not sync TON balance: {e}")
+            balances = (ton_future.result() or []) + (jettons_future.result() or [])
+            saved, failed = self._upsert_token_balances([(user_id,) + balance for balance in balances])
             
-            try:
-                jettons_url = f"{base_url.replace('/v2', '/v3')}/jetton/wallets?owner_address={wallet_address}&limit=100"
-                if self.use_testnet:
-                    jettons_url = f"https://testnet.toncenter.com/api/v3/jetton/wallets?owner_address={wallet_address}&limit=100"
-                
-                response = requests.get(jettons_url, headers=headers, timeout=10)
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    jettons = data.get('jetton_wallets', [])
-                    
-                    for jetton in jettons:
-                        try:
-                            jetton_master = jetton.get('jetton', {}).get('address', '')
-                            balance_raw = int(jetton.get('balance', 0))
-                            metadata = jetton.get('jetton', {}).get('metadata', {})
-                            
-                            decimals = int(metadata.get('decimals', 9))
-                            balance = Decimal(balance_raw) / Decimal(10**decimals)
-                            
-                            if balance > 0:
-                                self.update_token_balance(user_id, jetton_master, balance, {
-                                    'symbol': metadata.get('symbol', 'UNKNOWN'),
-                                    'name': metadata.get('name', 'Unknown Token'),
-                                    'decimals': decimals
-                                })
-                        except Exception as je:
-                            logger.warning(f"Could not process jetton: {je}")
-            except Exception as e:
-                logger.warning(f"Could not sync jetton balances: {e}")
+            if balances and not saved:
+                logger.error(f"Could not save any of {failed} balances for user {user_id}")
+                return {
+                    'success': False,
+                    'error': 'No se pudieron guardar los balances',
+                    'address': wallet_address,
+                    'balances_failed': failed
+                }
             
             return {
                 'success': True,
                 'message': 'Wallet synced with blockchain',
-                'address': wallet_address
+                'address': wallet_address,
+                'balances_saved': saved,
+                'balances_failed': failed
             }
             
         except Exception as e:
             logger.error(f"Error syncing wallet: {e}")
             return {'success': False, 'error': str(e)}
+    
+    def sync_all_wallets(self, user_ids: Optional[List[str]] = None,
+                         max_workers: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Sincronizar en bloque las wallets personales activas desde la blockchain.
+        
+        Args:
+            user_ids: Limitar a estos usuarios (por defecto todas las wallets activas)
+            max_workers: Maximo de peticiones simultaneas a TON Center (como mucho
+                SYNC_MAX_WORKERS, el tamano del pool de conexiones HTTP)
+            
+        Returns:
+            Dict con el resumen de la sincronizacion
+        """
+        started_at = datetime.now()
+        try:
+            with self.db.get_connection() as conn:
+                with conn.cursor() as cur:
+                    if user_ids is None:
+                        cur.execute("""
+                            SELECT user_id, address FROM user_wallets WHERE is_active = TRUE
+                        """)
+                    else:
+                        cur.execute("""
+                            SELECT user_id, address FROM user_wallets 
+                            WHERE is_active = TRUE AND user_id = ANY(%s)
+                        """, (list(user_ids),))
+                    wallets = cur.fetchall()
+        except Exception as e:
+            logger.error(f"Error loading wallets for batch sync: {e}")
+            return {'success': False, 'error': str(e)}
+        
+        synced = failed = balances_saved = balances_failed = 0
+        
+        workers = min(max_workers or self.SYNC_MAX_WORKERS, self.SYNC_MAX_WORKERS)
+        with ThreadPoolExecutor(max_workers=workers,
+                                thread_name_prefix='wallet-sync-batch') as executor:
+            for i in range(0, len(wallets), self.SYNC_BATCH_SIZE):
+                batch = wallets[i:i + self.SYNC_BATCH_SIZE]
+                futures = [
+                    (user_id,
+                     executor.submit(self._fetch_ton_balance, address),
+                     executor.submit(self._fetch_jetton_balances, address))
+                    for user_id, address in batch
+                ]
+                
+                rows = []
+                for user_id, ton_future, jettons_future in futures:
+                    ton, jettons = ton_future.result(), jettons_future.result()
+                    if ton is None and jettons is None:
+                        failed += 1
+                        continue
+                    synced += 1
+                    rows.extend((user_id,) + balance for balance in (ton or []) + (jettons or []))
+                
+                saved, not_saved = self._upsert_token_balances(rows)
+                balances_saved += saved
+                balances_failed += not_saved
+        
+        duration = (datetime.now() - started_at).total_seconds()
+        logger.info(f"Batch wallet sync: {synced} synced, {failed} failed, "
+                    f"{balances_saved} balances saved ({balances_failed} failed) in {duration:.1f}s")
+        
+        return {
+            'success': True,
+            'total_wallets': len(wallets),
+            'synced': synced,
+            'failed': failed,
+            'balances_saved': balances_saved,
+            'balances_failed': balances_failed,
+            'duration_seconds': round(duration, 1)
+        }
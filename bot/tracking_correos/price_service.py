@@ -1,16 +1,37 @@
 """
 Price Service - Servicio para obtener precios de criptomonedas desde CoinGecko
 Proporciona precios en USD y EUR con cache para evitar exceder rate limits.
+
+Un hilo en background refresca los precios antes de que expire el cache, y el
+ultimo valor obtenido se comparte entre workers via PostgreSQL (solo un worker
+consulta CoinGecko por ciclo). Las lecturas normales nunca esperan a la red:
+si el cache expiro se sirve el ultimo valor bueno con metadata de antiguedad.
 """
 
+import os
+import json
 import logging
 import requests
+import threading
 import time
 from typing import Dict, Any, Optional
 from datetime import datetime, timedelta
 
 logger = logging.getLogger(__name__)
 
+CREATE_PRICE_CACHE_SQL = """
+CREATE TABLE IF NOT EXISTS price_feed_cache (
+    cache_key VARCHAR(50) PRIMARY KEY,
+    prices JSONB NOT NULL,
+    eur_rate DOUBLE PRECISION,
+    fetched_at TIMESTAMP NOT NULL,
+    refresh_lease_until TIMESTAMP
+);
+ALTER TABLE price_feed_cache ADD COLUMN IF NOT EXISTS refresh_lease_until TIMESTAMP;
+"""
+
+PRICE_CACHE_KEY = 'coingecko'
+
 
 class PriceService:
     """Servicio para obtener precios de criptomonedas usando CoinGecko API."""
@@ -28,21 +49,31 @@ class PriceService:
     B3C_FIXED_PRICE_USD = 0.10
     
     CACHE_DURATION_SECONDS = 120
+    REFRESH_AHEAD_SECONDS = 90
+    REFRESH_POLL_SECONDS = 15
+    FORCE_REFRESH_MIN_AGE_SECONDS = 10
+    REFRESH_LEASE_SECONDS = 30
+    COLD_START_POLL_SECONDS = 0.5
     
     def __init__(self):
         """Inicializar el servicio de precios."""
         self._price_cache: Dict[str, Any] = {}
         self._cache_timestamp: Optional[datetime] = None
+        self._cache_source: Optional[str] = None
         self._eur_rate_cache: Optional[float] = None
         self._eur_rate_timestamp: Optional[datetime] = None
+        self._fetch_lock = threading.Lock()
+        self._refresher_lock = threading.Lock()
+        self._refresher_thread: Optional[threading.Thread] = None
+        self._refresher_pid: Optional[int] = None
+        self._shared_table_ready = False
         logger.info("PriceService initialized")
     
-    def _is_cache_valid(self) -> bool:
-        """Verificar si el cache de precios sigue válido."""
+    def _cache_age_seconds(self) -> Optional[float]:
+        """Segundos desde la ultima actualizacion de precios (None si no hay)."""
         if self._cache_timestamp is None:
-            return False
-        elapsed = (datetime.now() - self._cache_timestamp).total_seconds()
-        return elapsed < self.CACHE_DURATION_SECONDS
+            return None
+        return (datetime.now() - self._cache_timestamp).total_seconds()
     
     def _is_eur_rate_valid(self) -> bool:
         """Verificar si el cache del tipo de cambio EUR sigue válido."""
@@ -51,8 +82,8 @@ class PriceService:
         elapsed = (datetime.now() - self._eur_rate_timestamp).total_seconds()
         return elapsed < self.CACHE_DURATION_SECONDS * 5
     
-    def _fetch_prices(self) -> Dict[str, Dict[str, float]]:
-        """Obtener precios de CoinGecko API."""
+    def _fetch_prices(self) -> Optional[Dict[str, Dict[str, float]]]:
+        """Obtener precios de CoinGecko API. Devuelve None si la consulta falla."""
         try:
             coin_ids = [cid for cid in self.CRYPTO_IDS.values() if cid is not None]
             ids_param = ','.join(coin_ids)
@@ -88,21 +119,181 @@ class PriceService:
                         'eur': self.B3C_FIXED_PRICE_USD * 0.92
                     }
                 
-                self._price_cache = prices
-                self._cache_timestamp = datetime.now()
-                
                 logger.info(f"Prices updated: {prices}")
                 return prices
             else:
                 logger.warning(f"CoinGecko API returned status {response.status_code}")
-                return self._get_fallback_prices()
+                return None
                 
         except requests.exceptions.RequestException as e:
             logger.error(f"Error fetching prices from CoinGecko: {e}")
-            return self._get_fallback_prices()
+            return None
         except Exception as e:
             logger.error(f"Unexpected error fetching prices: {e}")
-            return self._get_fallback_prices()
+            return None
+    
+    def _store_prices(self, prices: Dict, fetched_at: datetime, source: str,
+                      eur_rate: Optional[float] = None):
+        """Guardar precios en el cache local del proceso."""
+        self._price_cache = prices
+        self._cache_timestamp = fetched_at
+        self._cache_source = source
+        if eur_rate:
+            self._eur_rate_cache = eur_rate
+            self._eur_rate_timestamp = fetched_at
+    
+    def _get_db(self):
+        """DatabaseManager para el cache compartido (None si no hay base de datos)."""
+        try:
+            from bot.tracking_correos.services import get_db_manager
+            return get_db_manager()
+        except Exception as e:
+            logger.debug(f"Shared price cache unavailable: {e}")
+            return None
+    
+    def _refresh(self, max_age: float):
+        """
+        Refrescar precios si el cache local es mas antiguo que max_age.
+        
+        Single-flight: dentro del proceso solo un hilo consulta a la vez (los demas
+        esperan y reutilizan el resultado), y entre workers solo el que obtiene el
+        lease en price_feed_cache consulta CoinGecko; el resto adopta el valor compartido.
+        """
+        with self._fetch_lock:
+            age = self._cache_age_seconds()
+            if age is not None and age < max_age:
+                return
+            
+            db = self._get_db()
+            if db is not None:
+                try:
+                    self._refresh_shared(db, max_age)
+                    return
+                except Exception as e:
+                    logger.error(f"Error refreshing shared price cache: {e}")
+                    age = self._cache_age_seconds()
+                    if age is not None and age < max_age:
+                        return
+            
+            prices = self._fetch_prices()
+            if prices:
+                self._store_prices(prices, datetime.now(), 'coingecko')
+    
+    def _refresh_shared(self, db, max_age: float, retry_cold: bool = True):
+        """
+        Adoptar el valor compartido mas reciente o, si se obtiene el lease, consultar CoinGecko.
+        
+        La consulta HTTP se hace sin conexion ni transaccion abiertas: primero una
+        transaccion corta lee el cache y reclama el lease (refresh_lease_until),
+        luego se consulta CoinGecko y al final otra transaccion corta guarda el resultado.
+        En frio (sin precios en este proceso) y con el lease en otro worker, se espera
+        a que ese worker publique el valor en lugar de servir precios estaticos.
+        """
+        with db.get_connection() as conn:
+            with conn.cursor() as cur:
+                if not self._shared_table_ready:
+                    cur.execute(CREATE_PRICE_CACHE_SQL)
+                    conn.commit()
+                    self._shared_table_ready = True
+                
+                cur.execute("""
+                    SELECT prices, eur_rate, fetched_at FROM price_feed_cache
+                    WHERE cache_key = %s
+                """, (PRICE_CACHE_KEY,))
+                row = cur.fetchone()
+                if row and row[0] and (self._cache_timestamp is None or row[2] > self._cache_timestamp):
+                    self._store_prices(row[0], row[2], 'shared_cache', row[1])
+                
+                age = self._cache_age_seconds()
+                if age is not None and age < max_age:
+                    conn.rollback()
+                    return
+                
+                cur.execute("""
+                    INSERT INTO price_feed_cache (cache_key, prices, fetched_at, refresh_lease_until)
+                    VALUES (%s, '{}'::jsonb, 'epoch', LOCALTIMESTAMP + make_interval(secs => %s))
+                    ON CONFLICT (cache_key) DO UPDATE SET
+                        refresh_lease_until = EXCLUDED.refresh_lease_until
+                    WHERE price_feed_cache.refresh_lease_until IS NULL
+                       OR price_feed_cache.refresh_lease_until < LOCALTIMESTAMP
+                    RETURNING cache_key
+                """, (PRICE_CACHE_KEY, self.REFRESH_LEASE_SECONDS))
+                have_lease = cur.fetchone() is not None
+                conn.commit()
+        
+        if not have_lease:
+            if not self._price_cache and not self._wait_for_shared(db) and retry_cold:
+                self._refresh_shared(db, max_age, retry_cold=False)
+            return
+        
+        prices = self._fetch_prices()
+        fetched_at = datetime.now()
+        if prices:
+            self._store_prices(prices, fetched_at, 'coingecko')
+        
+        with db.get_connection() as conn:
+            with conn.cursor() as cur:
+                if prices:
+                    cur.execute("""
+                        UPDATE price_feed_cache SET
+                            prices = %s,
+                            eur_rate = %s,
+                            fetched_at = %s,
+                            refresh_lease_until = NULL
+                        WHERE cache_key = %s
+                    """, (json.dumps(prices), self._eur_rate_cache, fetched_at, PRICE_CACHE_KEY))
+                else:
+                    cur.execute("""
+                        UPDATE price_feed_cache SET refresh_lease_until = NULL
+                        WHERE cache_key = %s
+                    """, (PRICE_CACHE_KEY,))
+                conn.commit()
+    
+    def _wait_for_shared(self, db) -> bool:
+        """
+        Releer price_feed_cache mientras otro worker tiene el lease (como mucho
+        REFRESH_LEASE_SECONDS). Devuelve True si se adopto un valor compartido.
+        """
+        deadline = time.time() + self.REFRESH_LEASE_SECONDS
+        while time.time() < deadline:
+            time.sleep(self.COLD_START_POLL_SECONDS)
+            with db.get_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        SELECT prices, eur_rate, fetched_at,
+                               refresh_lease_until IS NULL OR refresh_lease_until < LOCALTIMESTAMP
+                        FROM price_feed_cache WHERE cache_key = %s
+                    """, (PRICE_CACHE_KEY,))
+                    row = cur.fetchone()
+                    conn.rollback()
+            if row and row[0]:
+                self._store_prices(row[0], row[2], 'shared_cache', row[1])
+                return True
+            if not row or row[3]:
+                return False
+        return False
+    
+    def _ensure_refresher(self):
+        """Arrancar el hilo de refresco (una vez por proceso, tambien tras un fork)."""
+        pid = os.getpid()
+        if self._refresher_pid == pid and self._refresher_thread and self._refresher_thread.is_alive():
+            return
+        with self._refresher_lock:
+            if self._refresher_pid == pid and self._refresher_thread and self._refresher_thread.is_alive():
+                return
+            self._refresher_pid = pid
+            self._refresher_thread = threading.Thread(target=self._refresh_loop, daemon=True)
+            self._refresher_thread.start()
+            logger.info("PriceService background refresher started")
+    
+    def _refresh_loop(self):
+        """Mantener los precios calientes antes de que expire el cache."""
+        while True:
+            try:
+                self._refresh(max_age=self.REFRESH_AHEAD_SECONDS)
+            except Exception as e:
+                logger.error(f"Error in price refresh loop: {e}")
+            time.sleep(self.REFRESH_POLL_SECONDS)
     
     def _calculate_eur_rate(self, prices: Dict) -> Optional[float]:
         """Calcular tasa EUR/USD basándose en los precios de USDT."""
@@ -119,8 +310,8 @@ class PriceService:
             pass
         return self._eur_rate_cache or 0.92
     
-    def _get_fallback_prices(self) -> Dict[str, Dict[str, float]]:
-        """Obtener precios de respaldo en caso de error."""
+    def _current_prices(self) -> Dict[str, Dict[str, float]]:
+        """Ultimos precios obtenidos, o precios estaticos de respaldo si aun no hay."""
         if self._price_cache:
             return self._price_cache
         
@@ -132,20 +323,36 @@ class PriceService:
             'B3C': {'usd': self.B3C_FIXED_PRICE_USD, 'eur': self.B3C_FIXED_PRICE_USD * 0.92}
         }
     
-    def get_prices(self, force_refresh: bool = False) -> Dict[str, Dict[str, float]]:
+    def get_prices(self, force_refresh: bool = False, wait: bool = True) -> Dict[str, Dict[str, float]]:
         """
         Obtener precios actuales de todas las criptomonedas soportadas.
         
         Args:
             force_refresh: Forzar actualización ignorando cache
+            wait: En arranque en frio, esperar a la primera consulta (single-flight)
+                en lugar de devolver precios de respaldo
             
         Returns:
             Dict con precios en USD y EUR por símbolo
         """
-        if not force_refresh and self._is_cache_valid():
-            return self._price_cache
+        self._ensure_refresher()
         
-        return self._fetch_prices()
+        if force_refresh:
+            self._refresh(max_age=self.FORCE_REFRESH_MIN_AGE_SECONDS)
+        elif not self._price_cache and wait:
+            self._refresh(max_age=self.CACHE_DURATION_SECONDS)
+        
+        return self._current_prices()
+    
+    def get_price_status(self) -> Dict[str, Any]:
+        """Metadata de frescura de los precios servidos."""
+        age = self._cache_age_seconds()
+        return {
+            'source': self._cache_source or 'fallback',
+            'last_update': self._cache_timestamp.isoformat() if self._cache_timestamp else None,
+            'age_seconds': int(age) if age is not None else None,
+            'is_stale': age is None or age > self.CACHE_DURATION_SECONDS
+        }
     
     def get_price(self, symbol: str, currency: str = 'usd') -> float:
         """
@@ -158,7 +365,7 @@ class PriceService:
         Returns:
             Precio en la moneda especificada
         """
-        prices = self.get_prices()
+        prices = self.get_prices(wait=False)
         symbol_upper = symbol.upper()
         currency_lower = currency.lower()
         
@@ -178,7 +385,7 @@ class PriceService:
         Returns:
             Dict con total y desglose por token
         """
-        prices = self.get_prices()
+        prices = self.get_prices(wait=False)
         currency_lower = currency.lower()
         
         total = 0.0
@@ -210,7 +417,8 @@ class PriceService:
             'currency': currency_lower.upper(),
             'breakdown': breakdown,
             'prices': prices,
-            'last_update': self._cache_timestamp.isoformat() if self._cache_timestamp else None
+            'last_update': self._cache_timestamp.isoformat() if self._cache_timestamp else None,
+            'price_status': self.get_price_status()
         }
     
     def get_eur_usd_rate(self) -> float:
@@ -218,7 +426,7 @@ class PriceService:
         if self._is_eur_rate_valid() and self._eur_rate_cache:
             return self._eur_rate_cache
         
-        self.get_prices()
+        self.get_prices(wait=False)
         return self._eur_rate_cache or 0.92
 
 
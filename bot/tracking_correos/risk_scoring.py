@@ -0,0 +1,415 @@
+"""
+Risk Scoring - Calculo masivo de puntuacion de riesgo de usuarios
+Calcula los factores de riesgo de todos los usuarios (o solo de los que cambiaron
+desde la ultima ejecucion) con unas pocas consultas agrupadas y guarda los
+resultados en risk_scores / risk_score_history en bloque.
+"""
+
+import json
+import time
+import logging
+import threading
+from datetime import datetime
+from typing import Optional, Dict, List, Tuple
+
+import psycopg2.extras
+
+logger = logging.getLogger(__name__)
+
+RISK_ADVISORY_LOCK_ID = 702601
+TIME_WINDOW_FACTORS = ['transacciones_rapidas', 'retiros_altos', 'cuenta_nueva']
+
+CREATE_RISK_SCORING_STATE_SQL = """
+CREATE TABLE IF NOT EXISTS risk_scoring_state (
+    id INTEGER PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    last_run_at TIMESTAMP,
+    last_full_run_at TIMESTAMP,
+    last_result JSONB DEFAULT '{}'
+);
+"""
+
+
+def compute_risk_score(is_verified: bool, created_at: Optional[datetime], ip_count: int,
+                       shared_ip_count: int, alert_count: int, recent_tx_count: int,
+                       withdrawals_24h: float) -> Tuple[int, str, Dict[str, int]]:
+    """
+    Convertir los factores crudos de un usuario en score, nivel y desglose.
+
+    Returns:
+        Tupla (score 0-100, risk_level, factors)
+    """
+    factors = {}
+    score = 0
+
+    if not is_verified:
+        factors['no_verificado'] = 15
+        score += 15
+
+    if ip_count > 5:
+        factors['multiples_ips'] = min(ip_count * 3, 20)
+        score += factors['multiples_ips']
+
+    if shared_ip_count:
+        factors['ips_compartidas'] = min(shared_ip_count * 10, 25)
+        score += factors['ips_compartidas']
+
+    if alert_count > 0:
+        factors['alertas_activas'] = min(alert_count * 5, 20)
+        score += factors['alertas_activas']
+
+    if recent_tx_count > 10:
+        factors['transacciones_rapidas'] = min(recent_tx_count, 15)
+        score += factors['transacciones_rapidas']
+
+    if withdrawals_24h > 1000:
+        factors['retiros_altos'] = min(int(withdrawals_24h / 100), 20)
+        score += factors['retiros_altos']
+
+    account_age_days = 0
+    if created_at:
+        account_age_days = (datetime.now() - created_at).days
+    if account_age_days < 7:
+        factors['cuenta_nueva'] = 10
+        score += 10
+
+    score = min(score, 100)
+
+    if score >= 75:
+        risk_level = 'critical'
+    elif score >= 50:
+        risk_level = 'high'
+    elif score >= 25:
+        risk_level = 'medium'
+    else:
+        risk_level = 'low'
+
+    return score, risk_level, factors
+
+
+class RiskScoringEngine:
+    """Motor de calculo masivo de risk scores con ejecucion periodica en background."""
+
+    RUN_INTERVAL_SECONDS = 900
+    FULL_RUN_INTERVAL_SECONDS = 86400
+
+    def __init__(self, db_manager):
+        """
+        Inicializar el motor.
+
+        Args:
+            db_manager: Instancia de DatabaseManager
+        """
+        self.db = db_manager
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+        self._manual_thread: Optional[threading.Thread] = None
+        self._state_table_ready = False
+        self._last_result: Dict = {}
+
+        logger.info("RiskScoringEngine initialized")
+
+    def start(self):
+        """Iniciar el recalculo periodico en un hilo de background."""
+        if self._running:
+            logger.warning("RiskScoringEngine already running")
+            return
+
+        self._running = True
+        self._thread = threading.Thread(target=self._run_loop, daemon=True)
+        self._thread.start()
+        logger.info("RiskScoringEngine started - scoring every %d seconds", self.RUN_INTERVAL_SECONDS)
+
+    def stop(self):
+        """Detener el recalculo periodico."""
+        self._running = False
+        if self._thread:
+            self._thread.join(timeout=5)
+        logger.info("RiskScoringEngine stopped")
+
+    def _run_loop(self):
+        """Loop principal: recalculo incremental, con uno completo al dia."""
+        while self._running:
+            try:
+                self.run()
+            except Exception as e:
+                logger.error(f"[RISK] Error in risk scoring loop: {e}")
+
+            time.sleep(self.RUN_INTERVAL_SECONDS)
+
+    def trigger(self, only_changed: bool = True) -> bool:
+        """
+        Lanzar un recalculo en un hilo aparte (para peticiones HTTP).
+
+        Returns:
+            False si ya hay un recalculo manual en curso en este proceso
+        """
+        if self._manual_thread and self._manual_thread.is_alive():
+            return False
+
+        def _run():
+            try:
+                self.run(only_changed=only_changed)
+            except Exception as e:
+                logger.error(f"[RISK] Error in manual risk scoring run: {e}")
+
+        self._manual_thread = threading.Thread(target=_run, daemon=True)
+        self._manual_thread.start()
+        return True
+
+    def run(self, only_changed: bool = True) -> Dict:
+        """
+        Recalcular y guardar los risk scores.
+
+        La marca de la ultima ejecucion se guarda en risk_scoring_state y se lee
+        con el advisory lock tomado, asi todos los workers comparten el mismo punto
+        de partida. La ejecucion es completa si no hay marca previa o si la ultima
+        completa tiene mas de FULL_RUN_INTERVAL_SECONDS.
+
+        Args:
+            only_changed: Si True, solo recalcula usuarios con actividad desde la
+                ultima ejecucion; si False fuerza una ejecucion completa
+
+        Returns:
+            Dict con el resumen de la ejecucion
+        """
+        run_started = time.time()
+
+        from bot.tracking_correos.identity_links import get_identity_link_index
+        index = get_identity_link_index(self.db)
+        if not index.wait_until_loaded():
+            logger.error("[RISK] Identity link index unavailable, aborting run")
+            self._last_result = {'success': False, 'error': 'Identity link index unavailable',
+                                 'finished_at': datetime.now().isoformat()}
+            return self._last_result
+
+        with self.db.get_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+                if not self._state_table_ready:
+                    cur.execute(CREATE_RISK_SCORING_STATE_SQL)
+                    conn.commit()
+                    self._state_table_ready = True
+
+                cur.execute("""
+                    SELECT pg_try_advisory_xact_lock(%s) AS locked, LOCALTIMESTAMP AS now
+                """, (RISK_ADVISORY_LOCK_ID,))
+                lock_row = cur.fetchone()
+                if not lock_row['locked']:
+                    conn.rollback()
+                    logger.info("[RISK] Another worker is already scoring, skipping run")
+                    return {'success': True, 'skipped': True}
+                started_at = lock_row['now']
+
+                cur.execute("SELECT last_run_at, last_full_run_at FROM risk_scoring_state WHERE id = 1")
+                state = cur.fetchone() or {}
+                last_run_at = state.get('last_run_at')
+                last_full_run_at = state.get('last_full_run_at')
+
+                full = (not only_changed or last_run_at is None or last_full_run_at is None or
+                        (started_at - last_full_run_at).total_seconds() > self.FULL_RUN_INTERVAL_SECONDS)
+
+                user_ids = None if full else self._get_changed_user_ids(cur, index, last_run_at)
+                scores = self._compute_scores(cur, index, user_ids) if full or user_ids else {}
+                changed = self._save_scores(cur, scores)
+
+                result = {
+                    'success': True,
+                    'scored': len(scores),
+                    'changed': changed,
+                    'full': full,
+                    'started_at': started_at.isoformat(),
+                    'duration_ms': int((time.time() - run_started) * 1000),
+                    'finished_at': datetime.now().isoformat()
+                }
+                cur.execute("""
+                    INSERT INTO risk_scoring_state (id, last_run_at, last_full_run_at, last_result)
+                    VALUES (1, %s, %s, %s)
+                    ON CONFLICT (id) DO UPDATE SET
+                        last_run_at = EXCLUDED.last_run_at,
+                        last_full_run_at = EXCLUDED.last_full_run_at,
+                        last_result = EXCLUDED.last_result
+                """, (started_at, started_at if full else last_full_run_at, json.dumps(result)))
+            conn.commit()
+
+        self._last_result = result
+        logger.info(f"[RISK] Scored {len(scores)} users ({changed} changed, full={full})")
+        return result
+
+    def _fetch_alert_rows(self, cur, query: str, params) -> List:
+        """
+        Consultar security_alerts bajo un savepoint.
+
+        init_db.py puede crear la tabla con el esquema de models.py (columna
+        `resolved`, user_id BIGINT); en ese caso se cuentan 0 alertas, igual que
+        calculate_user_risk_score, en lugar de abortar toda la ejecucion.
+        """
+        cur.execute("SAVEPOINT risk_alerts")
+        try:
+            cur.execute(query, params)
+            rows = cur.fetchall()
+        except Exception as e:
+            cur.execute("ROLLBACK TO SAVEPOINT risk_alerts")
+            logger.warning(f"[RISK] security_alerts not usable, counting 0 alerts: {e}")
+            return []
+        cur.execute("RELEASE SAVEPOINT risk_alerts")
+        return rows
+
+    def _get_changed_user_ids(self, cur, index, since: datetime) -> List[str]:
+        """Usuarios con actividad que puede afectar su score desde `since`."""
+        cur.execute("""
+            SELECT id AS user_id FROM users
+            WHERE created_at >= %(since)s OR last_seen >= %(since)s OR updated_at >= %(since)s
+            UNION
+            SELECT user_id FROM trusted_devices
+            WHERE created_at >= %(since)s OR last_used_at >= %(since)s
+            UNION
+            SELECT user_id FROM wallet_transactions
+            WHERE created_at >= %(since)s::timestamp - INTERVAL '24 hours'
+            UNION
+            SELECT user_id FROM risk_scores
+            WHERE factors ?| %(window_factors)s
+        """, {'since': since, 'window_factors': TIME_WINDOW_FACTORS})
+        user_ids = {row['user_id'] for row in cur.fetchall() if row['user_id']}
+
+        user_ids.update(row['user_id'] for row in self._fetch_alert_rows(cur, """
+            SELECT DISTINCT user_id::text AS user_id FROM security_alerts
+            WHERE created_at >= %(since)s OR resolved_at >= %(since)s
+        """, {'since': since}) if row['user_id'])
+
+        for user_id in list(user_ids):
+            user_ids.update(index.get_related(user_id))
+
+        return list(user_ids)
+
+    def _compute_scores(self, cur, index, user_ids: Optional[List[str]]) -> Dict[str, Tuple[int, str, Dict]]:
+        """Calcular todos los factores con consultas agrupadas."""
+        user_filter = "" if user_ids is None else "AND user_id = ANY(%(user_ids)s)"
+        id_filter = "" if user_ids is None else "AND id = ANY(%(user_ids)s)"
+        params = {'user_ids': user_ids}
+
+        cur.execute(f"""
+            SELECT id AS user_id, is_verified, created_at FROM users
+            WHERE TRUE {id_filter}
+        """, params)
+        users = cur.fetchall()
+
+        cur.execute(f"""
+            SELECT user_id, COUNT(DISTINCT ip_address) AS ip_count
+            FROM trusted_devices WHERE TRUE {user_filter}
+            GROUP BY user_id
+        """, params)
+        ip_counts = {row['user_id']: row['ip_count'] for row in cur.fetchall()}
+
+        alert_filter = "" if user_ids is None else "AND user_id::text = ANY(%(user_ids)s)"
+        alert_counts = {row['user_id']: row['alert_count'] for row in self._fetch_alert_rows(cur, f"""
+            SELECT user_id::text AS user_id, COUNT(*) AS alert_count FROM security_alerts
+            WHERE is_resolved = false {alert_filter}
+            GROUP BY user_id
+        """, params)}
+
+        cur.execute(f"""
+            SELECT user_id,
+                   COUNT(*) FILTER (WHERE created_at >= NOW() - INTERVAL '1 hour') AS tx_count,
+                   COALESCE(SUM(amount) FILTER (WHERE transaction_type = 'withdraw'), 0) AS withdrawals
+            FROM wallet_transactions
+            WHERE created_at >= NOW() - INTERVAL '24 hours' {user_filter}
+            GROUP BY user_id
+        """, params)
+        tx_stats = {row['user_id']: row for row in cur.fetchall()}
+
+        scores = {}
+        for user in users:
+            user_id = user['user_id']
+            tx = tx_stats.get(user_id) or {}
+            scores[user_id] = compute_risk_score(
+                is_verified=user.get('is_verified'),
+                created_at=user.get('created_at'),
+                ip_count=ip_counts.get(user_id) or 0,
+                shared_ip_count=index.count_shared_ips(user_id),
+                alert_count=alert_counts.get(user_id) or 0,
+                recent_tx_count=tx.get('tx_count') or 0,
+                withdrawals_24h=float(tx.get('withdrawals') or 0)
+            )
+        return scores
+
+    def _save_scores(self, cur, scores: Dict[str, Tuple[int, str, Dict]]) -> int:
+        """Guardar scores e historial en bloque. Devuelve cuantos cambiaron."""
+        if not scores:
+            return 0
+
+        cur.execute("""
+            SELECT user_id, score, risk_level FROM risk_scores WHERE user_id = ANY(%s)
+        """, (list(scores.keys()),))
+        existing = {row['user_id']: row for row in cur.fetchall()}
+
+        history = []
+        for user_id, (score, risk_level, _) in scores.items():
+            old = existing.get(user_id)
+            if old and (old['score'] != score or old['risk_level'] != risk_level):
+                history.append((user_id, old['score'], score, old['risk_level'], risk_level,
+                                'Recalculo programado'))
+
+        if history:
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO risk_score_history (user_id, old_score, new_score, old_level, new_level, reason)
+                VALUES %s
+            """, history)
+
+        psycopg2.extras.execute_values(cur, """
+            INSERT INTO risk_scores (user_id, score, risk_level, factors, last_calculated)
+            VALUES %s
+            ON CONFLICT (user_id) DO UPDATE SET
+                score = EXCLUDED.score,
+                risk_level = EXCLUDED.risk_level,
+                factors = EXCLUDED.factors,
+                last_calculated = NOW(),
+                updated_at = NOW()
+        """, [(user_id, score, risk_level, json.dumps(factors))
+              for user_id, (score, risk_level, factors) in scores.items()],
+            template="(%s, %s, %s, %s, NOW())", page_size=1000)
+
+        return len(history) + len(scores) - len(existing)
+
+    def get_status(self) -> dict:
+        """Obtener estado del motor (la ultima ejecucion se lee de la base de datos)."""
+        status = {
+            'running': self._running,
+            'run_interval': self.RUN_INTERVAL_SECONDS,
+            'thread_alive': self._thread.is_alive() if self._thread else False,
+            'manual_run_in_progress': bool(self._manual_thread and self._manual_thread.is_alive()),
+            'last_run_at': None,
+            'last_full_run_at': None,
+            'last_result': self._last_result,
+            'last_error': self._last_result if self._last_result.get('success') is False else None
+        }
+        try:
+            with self.db.get_connection() as conn:
+                with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+                    cur.execute("""
+                        SELECT last_run_at, last_full_run_at, last_result
+                        FROM risk_scoring_state WHERE id = 1
+                    """)
+                    state = cur.fetchone()
+            if state:
+                status['last_run_at'] = state['last_run_at'].isoformat() if state['last_run_at'] else None
+                status['last_full_run_at'] = state['last_full_run_at'].isoformat() if state['last_full_run_at'] else None
+                status['last_result'] = state['last_result'] or self._last_result
+        except Exception as e:
+            logger.warning(f"[RISK] Could not read risk scoring state: {e}")
+        return status
+
+
+_engine_instance: Optional[RiskScoringEngine] = None
+
+def get_risk_scoring_engine(db_manager) -> RiskScoringEngine:
+    """Obtener o crear instancia singleton del motor de risk scoring."""
+    global _engine_instance
+    if _engine_instance is None:
+        _engine_instance = RiskScoringEngine(db_manager)
+    return _engine_instance
+
+def start_risk_scoring_engine(db_manager) -> RiskScoringEngine:
+    """Iniciar el recalculo periodico de risk scores."""
+    engine = get_risk_scoring_engine(db_manager)
+    if not engine._running:
+        engine.start()
+    return engine
@@ -33,6 +33,13 @@ CREATE TABLE IF NOT EXISTS trusted_devices (
 CREATE INDEX IF NOT EXISTS idx_trusted_devices_user ON trusted_devices(user_id);
 CREATE INDEX IF NOT EXISTS idx_trusted_devices_device ON trusted_devices(device_id);
 
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name='trusted_devices' AND column_name='device_fingerprint') THEN
+        ALTER TABLE trusted_devices ADD COLUMN device_fingerprint VARCHAR(255);
+    END IF;
+END $$;
+
 -- Tabla de intentos fallidos de wallet
 CREATE TABLE IF NOT EXISTS wallet_failed_attempts (
     id SERIAL PRIMARY KEY,
@@ -200,6 +207,8 @@ class SecurityManager:
                     """, (wallet_address, wallet_address, user_id))
                     conn.commit()
             
+            self._update_identity_links(user_id, wallet_address=wallet_address)
+            
             self.log_security_activity(
                 user_id, 'WALLET_REGISTERED',
                 f'Wallet primaria registrada: {wallet_address[:8]}...{wallet_address[-4:]}'
@@ -241,6 +250,7 @@ class SecurityManager:
                             UPDATE users SET wallet_address = %s WHERE telegram_id = %s
                         """, (wallet_address, user_id))
                         conn.commit()
+                self._update_identity_links(user_id, wallet_address=wallet_address)
                 return {
                     'success': True,
                     'is_registered_wallet': True,
@@ -414,7 +424,8 @@ class SecurityManager:
             return 0
     
     def add_trusted_device(self, user_id: str, device_id: str, device_name: str, 
-                          device_type: str, user_agent: str = None, ip_address: str = None) -> Dict:
+                          device_type: str, user_agent: str = None, ip_address: str = None,
+                          device_fingerprint: str = None) -> Dict:
         """Add a new trusted device for the user"""
         try:
             current_count = self.get_trusted_devices_count(user_id)
@@ -431,19 +442,25 @@ class SecurityManager:
                 with conn.cursor() as cur:
                     cur.execute("""
                         INSERT INTO trusted_devices 
-                        (user_id, device_id, device_name, device_type, user_agent, ip_address, expires_at)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s)
+                        (user_id, device_id, device_name, device_type, user_agent, ip_address, 
+                         device_fingerprint, expires_at)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
                         ON CONFLICT (user_id, device_id) 
                         DO UPDATE SET 
                             device_name = EXCLUDED.device_name,
+                            device_fingerprint = COALESCE(EXCLUDED.device_fingerprint, trusted_devices.device_fingerprint),
                             is_active = TRUE,
                             last_used_at = NOW(),
                             expires_at = EXCLUDED.expires_at
-                        RETURNING id
-                    """, (user_id, device_id, device_name, device_type, user_agent, ip_address, expires_at))
+                        RETURNING id, ip_address, device_fingerprint
+                    """, (user_id, device_id, device_name, device_type, user_agent, ip_address, 
+                          device_fingerprint, expires_at))
                     result = cur.fetchone()
                     conn.commit()
             
+            if result:
+                self._update_identity_links(user_id, ip_address=result[1], device_fingerprint=result[2])
+            
             self.log_security_activity(
                 user_id, 'DEVICE_ADDED',
                 f'Nuevo dispositivo de confianza: {device_name} ({device_type})',
@@ -467,6 +484,19 @@ class SecurityManager:
             logger.error(f"Error adding trusted device: {e}")
             return {'success': False, 'error': str(e)}
     
+    def _update_identity_links(self, user_id: str, ip_address: str = None,
+                               device_fingerprint: str = None, wallet_address: str = None):
+        """Propagate a new device or wallet to the related-accounts index"""
+        try:
+            from bot.tracking_correos.identity_links import get_identity_link_index
+            index = get_identity_link_index(self.db)
+            if wallet_address is not None:
+                index.set_wallet(user_id, wallet_address)
+            else:
+                index.add_device(user_id, ip_address, device_fingerprint)
+        except Exception as e:
+            logger.error(f"Error updating identity links for user {user_id}: {e}")
+    
     def remove_trusted_device(self, user_id: str, device_id: str) -> Dict:
         """Remove a trusted device"""
         try:
@@ -30,6 +30,8 @@ import psycopg2.extras
 
 from bot.tracking_correos.decorators import require_telegram_auth, require_owner
 from bot.tracking_correos.services import get_db_manager, get_security_manager
+from bot.tracking_correos.identity_links import get_identity_link_index, IdentityIndexUnavailable, LINK_IP
+from bot.tracking_correos.risk_scoring import compute_risk_score, get_risk_scoring_engine
 
 logger = logging.getLogger(__name__)
 
@@ -60,6 +62,8 @@ def admin_health():
             '/api/admin/users/<id>/risk-score',
             '/api/admin/users/<id>/risk-score/calculate',
             '/api/admin/users/<id>/risk-score/history',
+            '/api/admin/risk-score/recalculate',
+            '/api/admin/risk-score/status',
             '/api/admin/users/<id>/related-accounts',
             '/api/admin/users/<id>/tags',
             '/api/admin/stats',
@@ -406,91 +410,47 @@ def admin_dashboard_charts():
 
 def calculate_user_risk_score(user_id, conn):
     """Calcula el score de riesgo de un usuario basado en multiples factores."""
-    factors = {}
-    score = 0
-    
     with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
         cur.execute("SELECT * FROM users WHERE id = %s", (str(user_id),))
         user = cur.fetchone()
         if not user:
             return None, None, None
         
-        if not user.get('is_verified'):
-            factors['no_verificado'] = 15
-            score += 15
-        
         cur.execute("""
             SELECT COUNT(DISTINCT ip_address) as ip_count
             FROM trusted_devices WHERE user_id = %s
         """, (str(user_id),))
         ip_count = cur.fetchone()['ip_count'] or 0
-        if ip_count > 5:
-            factors['multiples_ips'] = min(ip_count * 3, 20)
-            score += factors['multiples_ips']
         
-        cur.execute("""
-            SELECT ip_address, COUNT(DISTINCT user_id) as user_count
-            FROM trusted_devices
-            WHERE ip_address IN (SELECT ip_address FROM trusted_devices WHERE user_id = %s)
-            AND user_id != %s
-            GROUP BY ip_address
-            HAVING COUNT(DISTINCT user_id) > 0
-        """, (str(user_id), str(user_id)))
-        shared_ips = cur.fetchall()
-        if shared_ips:
-            factors['ips_compartidas'] = min(len(shared_ips) * 10, 25)
-            score += factors['ips_compartidas']
+        shared_ips = get_identity_link_index(get_db_manager()).count_shared_ips(user_id)
         
+        alerts = 0
         try:
             cur.execute("""
                 SELECT COUNT(*) as alert_count FROM security_alerts
                 WHERE user_id = %s AND is_resolved = false
             """, (user.get('id'),))
             alerts = cur.fetchone()['alert_count'] or 0
-            if alerts > 0:
-                factors['alertas_activas'] = min(alerts * 5, 20)
-                score += factors['alertas_activas']
         except Exception:
             pass
         
         cur.execute("""
-            SELECT COUNT(*) as tx_count FROM wallet_transactions
-            WHERE user_id = %s AND created_at >= NOW() - INTERVAL '1 hour'
-        """, (str(user_id),))
-        recent_tx = cur.fetchone()['tx_count'] or 0
-        if recent_tx > 10:
-            factors['transacciones_rapidas'] = min(recent_tx, 15)
-            score += factors['transacciones_rapidas']
-        
-        cur.execute("""
-            SELECT COALESCE(SUM(amount), 0) as total FROM wallet_transactions
-            WHERE user_id = %s AND transaction_type = 'withdraw' 
-            AND created_at >= NOW() - INTERVAL '24 hours'
+            SELECT COUNT(*) FILTER (WHERE created_at >= NOW() - INTERVAL '1 hour') as tx_count,
+                   COALESCE(SUM(amount) FILTER (WHERE transaction_type = 'withdraw'), 0) as withdrawals
+            FROM wallet_transactions
+            WHERE user_id = %s AND created_at >= NOW() - INTERVAL '24 hours'
         """, (str(user_id),))
-        withdrawals = float(cur.fetchone()['total'] or 0)
-        if withdrawals > 1000:
-            factors['retiros_altos'] = min(int(withdrawals / 100), 20)
-            score += factors['retiros_altos']
-        
-        account_age_days = 0
-        if user.get('created_at'):
-            account_age_days = (datetime.now() - user['created_at']).days
-        if account_age_days < 7:
-            factors['cuenta_nueva'] = 10
-            score += 10
-        
-        score = min(score, 100)
-        
-        if score >= 75:
-            risk_level = 'critical'
-        elif score >= 50:
-            risk_level = 'high'
-        elif score >= 25:
-            risk_level = 'medium'
-        else:
-            risk_level = 'low'
+        tx = cur.fetchone()
     
-    return score, risk_level, factors
+    return compute_risk_score(
+        is_verified=user.get('is_verified'),
+        created_at=user.get('created_at'),
+        ip_count=ip_count,
+        shared_ip_count=shared_ips,
+        alert_count=alerts,
+        recent_tx_count=tx['tx_count'] or 0,
+        withdrawals_24h=float(tx['withdrawals'] or 0)
+    )
 
 
 @admin_bp.route('/users/<user_id>/ban', methods=['POST'])
@@ -965,6 +925,55 @@ def admin_calculate_risk_score(user_id):
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+@admin_bp.route('/risk-score/recalculate', methods=['POST'])
+@require_telegram_auth
+@require_owner
+def admin_recalculate_all_risk_scores():
+    """Admin: Recalcular en bloque el score de riesgo de todos los usuarios."""
+    try:
+        db_manager = get_db_manager()
+        if not db_manager:
+            return jsonify({'success': False, 'error': 'Base de datos no disponible'}), 500
+        
+        data = request.get_json(silent=True) or {}
+        only_changed = bool(data.get('onlyChanged', False))
+        
+        started = get_risk_scoring_engine(db_manager).trigger(only_changed=only_changed)
+        if not started:
+            return jsonify({
+                'success': False,
+                'error': 'Ya hay un recalculo en curso',
+                'status_url': '/api/admin/risk-score/status'
+            }), 409
+        
+        return jsonify({
+            'success': True,
+            'message': 'Recalculo iniciado en segundo plano',
+            'status_url': '/api/admin/risk-score/status'
+        }), 202
+        
+    except Exception as e:
+        logger.error(f"Error recalculating risk scores: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@admin_bp.route('/risk-score/status', methods=['GET'])
+@require_telegram_auth
+@require_owner
+def admin_get_risk_scoring_status():
+    """Admin: Estado del recalculo programado de scores de riesgo."""
+    try:
+        db_manager = get_db_manager()
+        if not db_manager:
+            return jsonify({'success': False, 'error': 'Base de datos no disponible'}), 500
+        
+        return jsonify({'success': True, 'status': get_risk_scoring_engine(db_manager).get_status()})
+        
+    except Exception as e:
+        logger.error(f"Error getting risk scoring status: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
 @admin_bp.route('/users/<user_id>/risk-score/history', methods=['GET'])
 @require_telegram_auth
 @require_owner
@@ -1008,63 +1017,33 @@ def admin_get_related_accounts(user_id):
             return jsonify({'success': False, 'error': 'Base de datos no disponible'}), 500
         
         related = []
+        links = get_identity_link_index(db_manager).get_related(user_id)
         
-        with db_manager.get_connection() as conn:
-            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-                cur.execute("""
-                    SELECT DISTINCT td2.user_id, u.username, td.ip_address
-                    FROM trusted_devices td
-                    JOIN trusted_devices td2 ON td.ip_address = td2.ip_address AND td.user_id != td2.user_id
-                    JOIN users u ON td2.user_id = u.id
-                    WHERE td.user_id = %s
-                """, (str(user_id),))
-                for row in cur.fetchall():
-                    related.append({
-                        'user_id': row['user_id'],
-                        'username': row['username'],
-                        'relation_type': 'same_ip',
-                        'evidence': {'ip': row['ip_address']}
-                    })
-                
-                cur.execute("""
-                    SELECT DISTINCT td2.user_id, u.username, td.device_fingerprint
-                    FROM trusted_devices td
-                    JOIN trusted_devices td2 ON td.device_fingerprint = td2.device_fingerprint 
-                        AND td.user_id != td2.user_id
-                        AND td.device_fingerprint IS NOT NULL
-                    JOIN users u ON td2.user_id = u.id
-                    WHERE td.user_id = %s
-                """, (str(user_id),))
-                for row in cur.fetchall():
-                    existing = next((r for r in related if r['user_id'] == row['user_id']), None)
-                    if existing:
-                        existing['relation_type'] = 'same_ip_and_device'
-                        existing['evidence']['fingerprint'] = row['device_fingerprint']
-                    else:
-                        related.append({
-                            'user_id': row['user_id'],
-                            'username': row['username'],
-                            'relation_type': 'same_device',
-                            'evidence': {'fingerprint': row['device_fingerprint']}
-                        })
-                
-                cur.execute("""
-                    SELECT DISTINCT u2.id as user_id, u2.username, u1.wallet_address
-                    FROM users u1
-                    JOIN users u2 ON u1.wallet_address = u2.wallet_address AND u1.id != u2.id
-                    WHERE u1.id = %s AND u1.wallet_address IS NOT NULL AND u1.wallet_address != ''
-                """, (str(user_id),))
-                for row in cur.fetchall():
-                    existing = next((r for r in related if r['user_id'] == row['user_id']), None)
-                    if existing:
-                        existing['evidence']['wallet'] = row['wallet_address']
-                    else:
-                        related.append({
-                            'user_id': row['user_id'],
-                            'username': row['username'],
-                            'relation_type': 'same_wallet',
-                            'evidence': {'wallet': row['wallet_address']}
-                        })
+        if links:
+            with db_manager.get_connection() as conn:
+                with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+                    cur.execute("""
+                        SELECT id, username FROM users WHERE id = ANY(%s)
+                    """, (list(links.keys()),))
+                    usernames = {row['id']: row['username'] for row in cur.fetchall()}
+            
+            for related_id, evidence in links.items():
+                if related_id not in usernames:
+                    continue
+                if 'ip' in evidence and 'fingerprint' in evidence:
+                    relation_type = 'same_ip_and_device'
+                elif 'ip' in evidence:
+                    relation_type = 'same_ip'
+                elif 'fingerprint' in evidence:
+                    relation_type = 'same_device'
+                else:
+                    relation_type = 'same_wallet'
+                related.append({
+                    'user_id': related_id,
+                    'username': usernames[related_id],
+                    'relation_type': relation_type,
+                    'evidence': evidence
+                })
         
         return jsonify({
             'success': True,
@@ -4102,30 +4081,28 @@ def admin_fraud_multiple_accounts():
         if not db_manager:
             return jsonify({'success': True, 'suspicious': []})
         
-        with db_manager.get_connection() as conn:
-            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-                cur.execute("""
-                    SELECT ip_address, COUNT(DISTINCT user_id) as user_count,
-                           ARRAY_AGG(DISTINCT user_id) as user_ids
-                    FROM trusted_devices
-                    WHERE ip_address IS NOT NULL AND ip_address != ''
-                    GROUP BY ip_address
-                    HAVING COUNT(DISTINCT user_id) > 1
-                    ORDER BY user_count DESC
-                    LIMIT 50
-                """)
-                results = cur.fetchall()
+        index = get_identity_link_index(db_manager)
         
         suspicious = []
-        for r in results:
+        for r in index.get_shared_links(LINK_IP, limit=50):
             suspicious.append({
-                'ip': r['ip_address'],
+                'ip': r['value'],
                 'user_count': r['user_count'],
                 'user_ids': r['user_ids']
             })
         
-        return jsonify({'success': True, 'suspicious': suspicious, 'count': len(suspicious)})
+        clusters = index.get_largest_clusters(limit=50)
         
+        return jsonify({
+            'success': True,
+            'suspicious': suspicious,
+            'count': len(suspicious),
+            'clusters': clusters
+        })
+        
+    except IdentityIndexUnavailable as e:
+        logger.error(f"Error detecting multiple accounts: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 503
     except Exception as e:
         logger.error(f"Error detecting multiple accounts: {e}")
         return jsonify({'success': True, 'suspicious': []})
@@ -383,6 +383,12 @@ def connect_wallet():
                 """, (wallet_address, user_id))
                 conn.commit()
         
+        try:
+            from bot.tracking_correos.identity_links import get_identity_link_index
+            get_identity_link_index(db_manager).set_wallet(user_id, wallet_address)
+        except Exception as e:
+            logger.error(f"Error updating identity links: {e}")
+        
         return jsonify({'success': True, 'message': 'Wallet conectada'})
         
     except Exception as e:
@@ -2228,6 +2234,7 @@ def get_total_balance():
             'breakdown': balance_result['breakdown'],
             'prices': balance_result['prices'],
             'last_update': balance_result['last_update'],
+            'price_status': balance_result['price_status'],
             'is_demo': False
         })
         
@@ -2247,7 +2254,8 @@ def get_crypto_prices():
         
         return jsonify({
             'success': True,
-            'prices': prices
+            'prices': prices,
+            'price_status': price_service.get_price_status()
         })
         
     except Exception as e:
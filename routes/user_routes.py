@@ -2550,7 +2550,8 @@ def add_security_device():
         ip_address = request.remote_addr or ''
         
         result = security_manager.add_trusted_device(
-            user_id, device_id, device_name, device_type, user_agent, ip_address
+            user_id, device_id, device_name, device_type, user_agent, ip_address,
+            str(data.get('deviceFingerprint') or '')[:255] or None
         )
         
         if result.get('max_reached'):